@@ -1,15 +1,20 @@
 """Python futures for Condor clusters."""
 from concurrent import futures
+import itertools
 import os
+import select
 import sys
 import threading
 import time
+import traceback
 from . import condor
 from . import slurm
 from .util import (
-    random_string, local_filename, INFILE_FMT, OUTFILE_FMT,
+    random_string, local_filename, INFILE_FMT, OUTFILE_FMT, FUNFILE_FMT,
+    FUNREF_TAG, pack_frames, unpack_frames, dumps, dump_function, loads,
+    readall, write_file,
+    inotify_watch, inotify_read, IN_CLOSE_WRITE, IN_MOVED_TO,
 )
-import cloudpickle
 
 __version__ = '0.4'
 
@@ -23,10 +28,16 @@ class RemoteException(Exception):
         return '\n' + self.error.strip()
 
 class FileWaitThread(threading.Thread):
-    """A thread that polls the filesystem waiting for a list of files to
-    be created. When a specified file is created, it invokes a callback.
+    """A thread that waits for a list of files to be created. When a
+    specified file is created, it invokes a callback.
+
+    On Linux, an inotify watch on ``directory`` reports new files as
+    soon as they appear. The filesystem is still polled every
+    ``interval`` seconds, since inotify does not see files written by
+    other hosts on network filesystems (and is not available at all on
+    other platforms).
     """
-    def __init__(self, callback, interval=1):
+    def __init__(self, callback, interval=1, directory=local_filename()):
         """The callable ``callback`` will be invoked with value
         associated with the filename of each file that is created.
         ``interval`` specifies the polling rate.
@@ -34,35 +45,134 @@ class FileWaitThread(threading.Thread):
         threading.Thread.__init__(self)
         self.callback = callback
         self.interval = interval
+        self.directory = directory
         self.waiting = {}
         self.lock = threading.Lock()
         self.shutdown = False
+        self.inotify_fd = inotify_watch(directory,
+                                        IN_CLOSE_WRITE | IN_MOVED_TO)
+
+        # Newly added files, checked as soon as the thread wakes up.
+        self.fresh = set()
+        # Wakes the thread early: an Event when polling, or a pipe that
+        # is selected on alongside the inotify descriptor.
+        self.wake_event = threading.Event()
+        if self.inotify_fd is None:
+            self.wake_fds = None
+        else:
+            self.wake_fds = os.pipe()
+            for fd in self.wake_fds:
+                os.set_blocking(fd, False)
+
+    def _wake(self):
+        # Must be called with the lock held.
+        self.wake_event.set()
+        if self.wake_fds is not None:
+            try:
+                os.write(self.wake_fds[1], b'\0')
+            except BlockingIOError:  # Already plenty of wakeups pending.
+                pass
 
     def stop(self):
         """Stop the thread soon."""
         with self.lock:
             self.shutdown = True
+            self._wake()
 
-    def wait(self, filename, value):
+    def wait(self, filename, value, check_now=True):
         """Adds a new filename (and its associated callback value) to
-        the set of files being waited upon.
+        the set of files being waited upon. Unless ``check_now`` is
+        false, the file is checked for right away rather than at the
+        next poll.
         """
         with self.lock:
             self.waiting[filename] = value
+            if check_now:
+                self.fresh.add(filename)
+                self._wake()
+
+    def _dispatch(self, filenames):
+        """Invoke the callback for each of the given (existing) files
+        that is still being waited upon. The callbacks run without the
+        lock held.
+        """
+        with self.lock:
+            values = [self.waiting.pop(filename) for filename in filenames
+                      if filename in self.waiting]
+        for value in values:
+            self.callback(value)
+
+    def _poll(self):
+        """Check for all the files being waited upon. Each directory
+        involved is listed once, rather than checking files one at a
+        time, and the lock is not held while listing.
+        """
+        with self.lock:
+            pending = set(self.waiting)
+
+        found = set()
+        for directory in {os.path.dirname(f) for f in pending}:
+            try:
+                with os.scandir(directory or os.curdir) as entries:
+                    found.update(os.path.join(directory, entry.name)
+                                 for entry in entries)
+            except OSError:
+                # E.g., missing, or a stale handle on a shared
+                # filesystem: try again at the next poll.
+                pass
+
+        self._dispatch(pending & found)
+
+    def _sleep(self, timeout):
+        """Wait for up to ``timeout`` seconds, or until woken up. Returns
+        the names of files reported by inotify in the meantime.
+        """
+        if self.inotify_fd is None:
+            self.wake_event.wait(timeout)
+            self.wake_event.clear()
+            return []
+
+        ready, _, _ = select.select([self.inotify_fd, self.wake_fds[0]],
+                                    [], [], timeout)
+        if self.wake_fds[0] in ready:
+            try:
+                while os.read(self.wake_fds[0], 4096):
+                    pass
+            except BlockingIOError:
+                pass
+        if self.inotify_fd in ready:
+            return inotify_read(self.inotify_fd)
+        return []
 
     def run(self):
-        while True:
+        try:
+            next_poll = time.monotonic()
+            while True:
+                names = self._sleep(max(0, next_poll - time.monotonic()))
+                with self.lock:
+                    if self.shutdown:
+                        return
+                    fresh, self.fresh = self.fresh, set()
+
+                # Dispatch files reported by inotify immediately.
+                if None in names:  # Overflow: events were lost.
+                    next_poll = time.monotonic()
+                self._dispatch(os.path.join(self.directory, name)
+                               for name in names if name is not None)
+
+                # Newly added files may have appeared before the wait.
+                self._dispatch([f for f in fresh if os.path.exists(f)])
+
+                # Fall back to polling for anything inotify missed.
+                if time.monotonic() >= next_poll:
+                    self._poll()
+                    next_poll = time.monotonic() + self.interval
+        finally:
             with self.lock:
-                if self.shutdown:
-                    return
-
-                # Poll for each file.
-                for filename in list(self.waiting):
-                    if os.path.exists(filename):
-                        self.callback(self.waiting[filename])
-                        del self.waiting[filename]
-
-            time.sleep(self.interval)
+                for fd in [self.inotify_fd, *(self.wake_fds or ())]:
+                    if fd is not None:
+                        os.close(fd)
+                self.inotify_fd = self.wake_fds = None
 
 class ClusterExecutor(futures.Executor):
     """An abstract base class for executors that run jobs on clusters.
@@ -72,12 +182,23 @@ class ClusterExecutor(futures.Executor):
         self.debug = debug
 
         self.jobs = {}
+        # Jobs whose completion has been handed to the completion pool.
+        self.completing = set()
         self.job_outfiles = {}
         self.jobs_lock = threading.Lock()
         self.jobs_empty_cond = threading.Condition(self.jobs_lock)
         self.keep_logs = keep_logs
 
-        self.wait_thread = FileWaitThread(self._completion)
+        # Worker IDs are a random prefix, unique to this executor,
+        # followed by a counter.
+        self._workerid_prefix = random_string(16)
+        self._workerid_counter = itertools.count()
+
+        # Output files are read and unpickled on a pool of threads, so
+        # that many jobs finishing together are handled in parallel.
+        self.completion_pool = futures.ThreadPoolExecutor(os.cpu_count())
+
+        self.wait_thread = FileWaitThread(self._completion_async)
         self.wait_thread.start()
 
     def _start(self, workerid, additional_setup_lines):
@@ -92,23 +213,63 @@ class ClusterExecutor(futures.Executor):
         cleanup after the job has finished.
         """
 
+    def _completion_async(self, jobid):
+        """Run ``_completion`` on the pool, reporting any exception it
+        raises (which would otherwise be lost with its future).
+        """
+        with self.jobs_lock:
+            self.completing.add(jobid)
+        fut = self.completion_pool.submit(self._completion, jobid)
+        fut.add_done_callback(self._report_completion_error)
+
+    @staticmethod
+    def _report_completion_error(fut):
+        exc = None if fut.cancelled() else fut.exception()
+        if exc is not None:
+            print("error while completing job:", file=sys.stderr)
+            traceback.print_exception(type(exc), exc, exc.__traceback__,
+                                      file=sys.stderr)
+
     def _completion(self, jobid):
         """Called whenever a job finishes."""
+        try:
+            self._complete(jobid)
+        finally:
+            with self.jobs_lock:
+                self.completing.discard(jobid)
+
+    def _complete(self, jobid):
         with self.jobs_lock:
-            fut, workerid = self.jobs.pop(jobid)
+            fut, workerid = self.jobs[jobid]
+
+        # Opening the output file is the only check that it exists. If
+        # it cannot be opened after all (it is gone, or the shared
+        # filesystem reports an error), try again at the next poll.
+        try:
+            outfile = open(OUTFILE_FMT % workerid, 'rb', buffering=0)
+        except OSError:
+            self.wait_thread.wait(OUTFILE_FMT % workerid, jobid,
+                                  check_now=False)
+            return
+
+        with self.jobs_lock:
+            del self.jobs[jobid]
             if not self.jobs:
                 self.jobs_empty_cond.notify_all()
         if self.debug:
-            print("job completed: %i" % jobid, file=sys.stderr)
-
-        with open(OUTFILE_FMT % workerid, 'rb') as f:
-            outdata = f.read()
-        success, result = cloudpickle.loads(outdata)
+            print("job completed: %s" % jobid, file=sys.stderr)
 
-        if success:
-            fut.set_result(result)
+        try:
+            with outfile:
+                outdata = readall(outfile)
+            success, result = loads(unpack_frames(outdata))
+        except Exception as exc:
+            fut.set_exception(exc)
         else:
-            fut.set_exception(RemoteException(result))
+            if success:
+                fut.set_result(result)
+            else:
+                fut.set_exception(RemoteException(result))
 
         # Clean up communication files.
         os.unlink(INFILE_FMT % workerid)
@@ -116,40 +277,93 @@ class ClusterExecutor(futures.Executor):
 
         self._cleanup(jobid)
 
-    def submit(self, fun, *args, additional_setup_lines=None, **kwargs):
-        """Submit a job to the pool.
+    def _new_workerid(self):
+        return '{}_{}'.format(self._workerid_prefix,
+                              next(self._workerid_counter))
 
-        If additional_setup_lines is passed, it overrides the lines given
-        when creating the executor.
+    def _write_input(self, workerid, funser, args, kwargs):
+        """Write the input file for a job that calls the pickled
+        function ``funser`` (or refers to a shared function file).
         """
-        fut = futures.Future()
+        frames = [funser] + dumps((args, kwargs))
+        write_file(INFILE_FMT % workerid, pack_frames(frames))
 
-        # Start the job.
-        workerid = random_string()
-        funcser = cloudpickle.dumps((fun, args, kwargs))
-        with open(INFILE_FMT % workerid, 'wb') as f:
-            f.write(funcser)
-        jobid = self._start(workerid, additional_setup_lines)
+    def _track(self, jobid, workerid):
+        """Return a future for a started job and wait for its output."""
+        fut = futures.Future()
 
         if self.debug:
-            print("job submitted: %i" % jobid, file=sys.stderr)
-
-        # Thread will wait for it to finish.
-        self.wait_thread.wait(OUTFILE_FMT % workerid, jobid)
+            print("job submitted: %s" % jobid, file=sys.stderr)
 
+        # Record the job before waiting on it: the wait thread may
+        # report completion as soon as the output file appears.
         with self.jobs_lock:
             self.jobs[jobid] = (fut, workerid)
+
+        # Thread will wait for it to finish.
+        self.wait_thread.wait(OUTFILE_FMT % workerid, jobid)
         return fut
 
+    def submit(self, fun, *args, additional_setup_lines=None, **kwargs):
+        """Submit a job to the pool.
+
+        If additional_setup_lines is passed, it overrides the lines given
+        when creating the executor.
+        """
+        # Start the job.
+        workerid = self._new_workerid()
+        self._write_input(workerid, dump_function(fun), args, kwargs)
+        jobid = self._start(workerid, additional_setup_lines)
+        return self._track(jobid, workerid)
+
     def shutdown(self, wait=True):
         """Close the pool."""
         if wait:
             with self.jobs_lock:
-                if self.jobs:
-                    self.jobs_empty_cond.wait()
+                self.jobs_empty_cond.wait_for(lambda: not self.jobs)
 
         self.wait_thread.stop()
         self.wait_thread.join()
+        self.completion_pool.shutdown(wait)
+
+        # Jobs that were not collected may still be queued or running,
+        # so their input files must stay. Only the files of jobs whose
+        # output has already appeared (and which are not being
+        # completed on the pool already) are removed.
+        self._remove_finished()
+
+    def _remove_finished(self):
+        """Remove the communication files of outstanding jobs that have
+        in fact finished (their output file exists), except those whose
+        completion is already queued or running. The directory is
+        listed once rather than trying each possible file. Returns the
+        set of worker IDs whose files were removed.
+        """
+        with self.jobs_lock:
+            workerids = [workerid for jobid, (_, workerid)
+                         in self.jobs.items()
+                         if jobid not in self.completing]
+        if not workerids:
+            return set()
+
+        with os.scandir(local_filename()) as entries:
+            names = {entry.name for entry in entries}
+
+        def unlink(name):
+            try:
+                os.unlink(local_filename(name))
+            except FileNotFoundError:
+                pass
+
+        finished = set()
+        for workerid in workerids:
+            inname = os.path.basename(INFILE_FMT % workerid)
+            outname = os.path.basename(OUTFILE_FMT % workerid)
+            if outname in names:
+                unlink(inname)
+                unlink(outname)
+                finished.add(workerid)
+        return finished
 
 class SlurmExecutor(ClusterExecutor):
     """Futures executor for executing jobs on a Slurm cluster.
@@ -157,10 +371,20 @@ class SlurmExecutor(ClusterExecutor):
     additional_setup_lines is a list of lines to include in the shell script
     passed to sbatch. They may include sbatch options (starting with
     '#SBATCH') and shell commands, e.g. to set environment variables.
+
+    max_array_size limits the number of tasks in each job array started
+    by submit_array; it should not exceed the cluster's MaxArraySize
+    (1001 by default).
     """
-    def __init__(self, debug=False, keep_logs=False, additional_setup_lines=()):
+    def __init__(self, debug=False, keep_logs=False, additional_setup_lines=(),
+                 max_array_size=1000):
         super().__init__(debug, keep_logs)
         self.additional_setup_lines = additional_setup_lines
+        self.max_array_size = max_array_size
+
+        # Shared function files of job arrays, with the number of
+        # their tasks that are still outstanding.
+        self.arrays = {}
 
     def _start(self, workerid, additional_setup_lines):
         if additional_setup_lines is None:
@@ -170,7 +394,82 @@ class SlurmExecutor(ClusterExecutor):
             additional_setup_lines=additional_setup_lines
         )
 
+    def submit_array(self, fun, allargs, additional_setup_lines=None):
+        """Submit Slurm job arrays that call ``fun`` once for each element
+        of ``allargs``, using one sbatch invocation per
+        ``max_array_size`` elements. Returns a list of futures in the
+        same order as ``allargs``.
+
+        If additional_setup_lines is passed, it overrides the lines given
+        when creating the executor.
+        """
+        allargs = list(allargs)
+        if additional_setup_lines is None:
+            additional_setup_lines = self.additional_setup_lines
+
+        funser = dump_function(fun)
+        futs = []
+        for start in range(0, len(allargs), self.max_array_size):
+            futs += self._submit_array(
+                funser, allargs[start:start + self.max_array_size],
+                additional_setup_lines,
+            )
+        return futs
+
+    def _submit_array(self, funser, allargs, additional_setup_lines):
+        """Start a single job array, with one task for each element of
+        ``allargs``, calling the pickled function ``funser``.
+        """
+        # Task i of the array runs the worker ID "<base>_<i>". The
+        # function is written once, to a file shared by all the tasks.
+        base = self._new_workerid()
+        funfile = FUNFILE_FMT % base
+        funref = FUNREF_TAG + os.path.basename(funfile).encode()
+        workerids = ['{}_{}'.format(base, i) for i in range(len(allargs))]
+
+        # Writing many small files to a shared filesystem is dominated by
+        # round trips to its server, which threads can overlap.
+        def write_input(workerid, arg):
+            self._write_input(workerid, funref, (arg,), {})
+
+        try:
+            write_file(funfile, pack_frames([funser]))
+            with futures.ThreadPoolExecutor(min(32, len(allargs))) as pool:
+                list(pool.map(write_input, workerids, allargs))
+
+            arrayid = slurm.submit(
+                '{} -m cfut.remote {}_$SLURM_ARRAY_TASK_ID'.format(
+                    sys.executable, base
+                ),
+                outpat=slurm.OUTFILE_FMT.format('%A_%a'),
+                additional_setup_lines=additional_setup_lines,
+                array_size=len(allargs),
+            )
+        except BaseException:
+            # Nothing will run, so don't leave the files behind.
+            for filename in [funfile] + [INFILE_FMT % w for w in workerids]:
+                try:
+                    os.unlink(filename)
+                except FileNotFoundError:
+                    pass
+            raise
+
+        with self.jobs_lock:
+            self.arrays[str(arrayid)] = [funfile, len(allargs)]
+        return [self._track('{}_{}'.format(arrayid, i), workerid)
+                for i, workerid in enumerate(workerids)]
+
     def _cleanup(self, jobid):
+        if isinstance(jobid, str):  # A task of a job array.
+            arrayid = jobid.rsplit('_', 1)[0]
+            with self.jobs_lock:
+                array = self.arrays[arrayid]
+                array[1] -= 1
+                if not array[1]:
+                    del self.arrays[arrayid]
+            if not array[1]:
+                os.unlink(array[0])
+
         if self.keep_logs:
             return
 
@@ -180,6 +479,26 @@ class SlurmExecutor(ClusterExecutor):
         except OSError:
             pass
 
+    def _remove_finished(self):
+        finished = super()._remove_finished()
+
+        # A shared function file is only unused once none of its array's
+        # tasks can still run or is still being completed.
+        with self.jobs_lock:
+            live = {jobid.rsplit('_', 1)[0]
+                    for jobid, (_, workerid) in self.jobs.items()
+                    if isinstance(jobid, str) and workerid not in finished}
+            live.update(jobid.rsplit('_', 1)[0] for jobid in self.completing
+                        if isinstance(jobid, str))
+            funfiles = [funfile for arrayid, (funfile, _)
+                        in self.arrays.items() if arrayid not in live]
+        for funfile in funfiles:
+            try:
+                os.unlink(funfile)
+            except FileNotFoundError:
+                pass
+        return finished
+
 class CondorExecutor(ClusterExecutor):
     """Futures executor for executing jobs on a Condor cluster."""
     def __init__(self, debug=False, keep_logs=False):
@@ -206,10 +525,15 @@ def map(executor, func, args, ordered=True):
     a function and an iterable, generates results. (Works like
     ``itertools.imap``.) If ``ordered`` is False, then the values are
     generated in an undefined order, possibly more quickly.
+
+    Executors that support job arrays submit all the jobs at once.
     """
     with executor:
-        futs = []
-        for arg in args:
-            futs.append(executor.submit(func, arg))
+        if hasattr(executor, 'submit_array'):
+            futs = executor.submit_array(func, args)
+        else:
+            futs = []
+            for arg in args:
+                futs.append(executor.submit(func, arg))
         for fut in (futs if ordered else futures.as_completed(futs)):
             yield fut.result()
@@ -1,36 +1,48 @@
 """Tools for executing remote commands."""
 import cloudpickle
 import sys
-import os
 import traceback
-from .util import INFILE_FMT, OUTFILE_FMT
+from .util import (
+    INFILE_FMT, OUTFILE_FMT, FUNREF_TAG, FUNIMPORT_TAG, local_filename,
+    pack_frames, unpack_frames, dumps, loads, read_file, write_file,
+    resolve_name,
+)
 
 def format_remote_exc():
     typ, value, tb = sys.exc_info()
     tb = tb.tb_next  # Remove root call to worker().
     return ''.join(traceback.format_exception(typ, value, tb))
 
+def load_function(funser):
+    """Load the function of a job, reading it from a shared function
+    file if the input refers to one.
+    """
+    if funser[:len(FUNREF_TAG)] == FUNREF_TAG:
+        name = bytes(funser[len(FUNREF_TAG):]).decode()
+        funser, = unpack_frames(read_file(local_filename(name)))
+    if funser[:len(FUNIMPORT_TAG)] == FUNIMPORT_TAG:
+        name = bytes(funser[len(FUNIMPORT_TAG):]).decode()
+        return resolve_name(*name.split('\0'))
+    return cloudpickle.loads(funser)
+
 def worker(workerid):
     """Called to execute a job on a remote host."""
     print("worker")
     try:
-        with open(INFILE_FMT % workerid, 'rb') as f:
-            indata = f.read()
-        fun, args, kwargs = cloudpickle.loads(indata)
+        indata = read_file(INFILE_FMT % workerid)
+        funser, *argframes = unpack_frames(indata)
+        fun = load_function(funser)
+        args, kwargs = loads(argframes)
         result = True, fun(*args, **kwargs)
-        out = cloudpickle.dumps(result)
+        out = dumps(result)
 
     except Exception as e:
         print(traceback.format_exc())
 
         result = False, format_remote_exc()
-        out = cloudpickle.dumps(result)
+        out = dumps(result)
 
-    destfile = OUTFILE_FMT % workerid
-    tempfile = destfile + '.tmp'
-    with open(tempfile, 'wb') as f:
-        f.write(out)
-    os.rename(tempfile, destfile)
+    write_file(OUTFILE_FMT % workerid, pack_frames(out))
 
 if __name__ == '__main__':
     worker(*sys.argv[1:])
@@ -1,7 +1,6 @@
 """Abstracts access to a Slurm cluster via its command-line tools.
 """
-import os
-from .util import chcall, random_string, local_filename
+from .util import chcall, local_filename
 
 LOG_FILE = local_filename("slurmpy.log")
 OUTFILE_FMT = local_filename("slurmpy.stdout.{}.log")
@@ -10,19 +9,25 @@ def submit_text(job):
     """Submits a Slurm job represented as a job file string. Returns
     the job ID.
     """
-    filename = local_filename('_temp_{}.sh'.format(random_string()))
-    with open(filename, 'w') as f:
-        f.write(job)
-    jobid, _ = chcall('sbatch --parsable {}'.format(filename))
-    os.unlink(filename)
-    return int(jobid)
+    # sbatch reads the script from stdin, so no temporary file is needed
+    # on the (shared) filesystem. With --parsable it prints just
+    # "jobid" or "jobid;cluster".
+    out, _ = chcall(['sbatch', '--parsable'], job.encode('utf-8'))
+    return int(out.split(b';')[0])
 
-def submit(cmdline, outpat=OUTFILE_FMT.format('%j'), additional_setup_lines=[]):
+def submit(cmdline, outpat=OUTFILE_FMT.format('%j'), additional_setup_lines=[],
+           array_size=None):
     """Starts a Slurm job that runs the specified shell command line.
+    If ``array_size`` is given, starts a job array with tasks numbered
+    from 0 to ``array_size - 1`` instead.
     """
+    array_lines = []
+    if array_size is not None:
+        array_lines.append("#SBATCH --array=0-{}".format(array_size - 1))
     script_lines = [
         "#!/bin/sh",
         "#SBATCH --output={}".format(outpat),
+        *array_lines,
         *additional_setup_lines,
         "srun {}".format(cmdline),
     ]
@@ -1,23 +1,297 @@
+import ctypes
+import ctypes.util
+import importlib
+import io
+import pickle
 import subprocess
-import random
-import string
+import struct
+import sys
+import types
 import os
+import cloudpickle
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
 
 def local_filename(filename=""):
     return os.path.join(os.getenv("CFUT_DIR", ".cfut"), filename)
 
 INFILE_FMT = local_filename('cfut.in.%s.pickle')
 OUTFILE_FMT = local_filename('cfut.out.%s.pickle')
+FUNFILE_FMT = local_filename('cfut.fun.%s.pickle')
+
+# Stands in for the pickled function in an input file, followed by the
+# name of a function file shared by several jobs.
+FUNREF_TAG = b'REF\0'
+# Stands in for the pickled function, followed by the names of its
+# module and the function itself (separated by a NUL byte).
+FUNIMPORT_TAG = b'IMP\0'
+
+# Messages larger than this are compressed, if lz4 is installed.
+COMPRESS_THRESHOLD = 64 * 1024
+_RAW_TAG = b'RAW\0'
+_LZ4_TAG = b'LZ4\0'
+
+def pack_frames(frames, compress=True):
+    """Lay out a message consisting of several byte strings ("frames").
+    Returns a list of segments to be written consecutively: a tag
+    naming the compression used, a header holding the number of frames
+    and their lengths, then the frames.
+
+    Large messages are compressed with LZ4 when the optional ``lz4``
+    package is available; shared filesystems are usually limited by
+    bandwidth, so moving fewer bytes outweighs the compression time.
+    """
+    lengths = [len(frame) for frame in frames]
+    header = struct.pack('<I%dQ' % len(lengths), len(lengths), *lengths)
+    segments = [header] + list(frames)
+
+    if compress and lz4 is not None and sum(lengths) > COMPRESS_THRESHOLD:
+        compressor = lz4.frame.LZ4FrameCompressor()
+        compressed = [compressor.begin()]
+        compressed += [compressor.compress(seg) for seg in segments]
+        compressed.append(compressor.flush())
+        return [_LZ4_TAG] + compressed
+    return [_RAW_TAG] + segments
+
+def unpack_frames(data):
+    """Split a message written by ``pack_frames`` back into its frames,
+    which are returned as memoryviews into ``data`` (or into a
+    decompressed copy of it).
+    """
+    data = memoryview(data)
+    tag, data = data[:4], data[4:]
+    if tag == _LZ4_TAG:
+        if lz4 is None:
+            raise RuntimeError('message is compressed, but the lz4 '
+                               'package is not installed')
+        data = memoryview(bytearray(lz4.frame.decompress(data)))
+    elif tag != _RAW_TAG:
+        raise ValueError('unknown message format {!r}'.format(bytes(tag)))
+
+    count, = struct.unpack_from('<I', data)
+    lengths = struct.unpack_from('<%dQ' % count, data, 4)
+    pos = 4 + 8 * count
+    frames = []
+    for length in lengths:
+        frames.append(data[pos:pos + length])
+        pos += length
+    return frames
 
-def random_string(length=32, chars=(string.ascii_letters + string.digits)):
-    return ''.join(random.choice(chars) for i in range(length))
+def _by_value_modules():
+    """The modules registered with cloudpickle's
+    ``register_pickle_by_value`` (available since cloudpickle 2.0).
+    """
+    registry = getattr(cloudpickle, 'list_registry_pickle_by_value', None)
+    return registry() if registry else set()
+
+def _pickled_by_value(module, registry):
+    """Whether functions and classes from the module named ``module``
+    must be pickled by value: those from ``__main__``, which is a
+    different module in the remote process, and from modules (or
+    packages) registered in ``registry``.
+    """
+    if module == '__main__':
+        return True
+    while module:
+        if module in registry:
+            return True
+        module = module.rpartition('.')[0]
+    return False
+
+class _Pickler(pickle.Pickler):
+    """The standard (C) pickler, refusing functions and classes that
+    cloudpickle would pickle by value (see ``_pickled_by_value``), since
+    this pickler could only pickle them by reference.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.by_value = _by_value_modules()
+
+    def reducer_override(self, obj):
+        if isinstance(obj, (type, types.FunctionType)):
+            module = getattr(obj, '__module__', None)
+            if isinstance(module, str) and \
+                    _pickled_by_value(module, self.by_value):
+                raise pickle.PicklingError(
+                    '%r must be pickled by value' % obj
+                )
+        return NotImplemented
+
+def dumps(obj):
+    """Pickle ``obj`` using protocol 5 and return a list of frames: the
+    pickle stream followed by any out-of-band buffers (such as the data
+    of NumPy arrays), which are not copied.
+
+    The standard pickler is tried first, since it is much faster than
+    cloudpickle for plain data. cloudpickle is used for anything it
+    cannot handle, like lambdas and closures.
+    """
+    buffers = []
+    try:
+        f = io.BytesIO()
+        _Pickler(f, protocol=5, buffer_callback=buffers.append).dump(obj)
+        data = f.getvalue()
+    except (pickle.PicklingError, AttributeError, TypeError):
+        buffers = []
+        data = cloudpickle.dumps(obj, protocol=5,
+                                 buffer_callback=buffers.append)
+    return [data] + [buf.raw() for buf in buffers]
+
+def resolve_name(module, qualname):
+    """Import ``module`` and look up the (qualified) name ``qualname``
+    in it.
+    """
+    obj = importlib.import_module(module)
+    for attr in qualname.split('.'):
+        obj = getattr(obj, attr)
+    return obj
+
+def dump_function(fun):
+    """Serialize a function for a job. Functions that the worker can
+    simply import by name are sent as their module and qualified name;
+    anything else (closures, lambdas, functions defined in ``__main__``
+    or in modules registered with ``register_pickle_by_value``) is
+    pickled with cloudpickle.
+    """
+    module = getattr(fun, '__module__', None)
+    qualname = getattr(fun, '__qualname__', None)
+    if isinstance(module, str) and isinstance(qualname, str) and \
+            not _pickled_by_value(module, _by_value_modules()):
+        try:
+            importable = resolve_name(module, qualname) is fun
+        except Exception:
+            importable = False
+        if importable:
+            name = '{}\0{}'.format(module, qualname)
+            return FUNIMPORT_TAG + name.encode()
+    return cloudpickle.dumps(fun)
+
+def loads(frames):
+    """Unpickle an object from the frames produced by ``dumps``."""
+    return cloudpickle.loads(frames[0], buffers=frames[1:])
+
+def readall(f):
+    """Read the rest of an unbuffered binary file into a (writable)
+    bytearray, using as few read calls as possible.
+    """
+    fd = f.fileno()
+    data = bytearray(os.fstat(fd).st_size - f.tell())
+    if hasattr(os, 'posix_fadvise'):
+        # Ask for aggressive readahead: the whole file is wanted.
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+    view = memoryview(data)
+    pos = 0
+    while pos < len(data):
+        count = f.readinto(view[pos:])
+        if not count:
+            break
+        pos += count
+    del view
+    del data[pos:]
+    return data
+
+def read_file(filename):
+    """Read an entire file into a (writable) bytearray."""
+    with open(filename, 'rb', buffering=0) as f:
+        return readall(f)
+
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+
+def write_file(filename, segments):
+    """Atomically write the concatenation of the byte strings in
+    ``segments`` to ``filename``. The data is gathered into a temporary
+    file with ``writev``, flushed, and then renamed into place, so that
+    readers never observe a partially written file.
+    """
+    segments = [memoryview(seg).cast('B') for seg in segments if len(seg)]
+    tempname = filename + '.tmp'
+    fd = os.open(tempname, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+    try:
+        start = 0
+        while start < len(segments):
+            written = os.writev(fd, segments[start:start + IOV_MAX])
+            # Skip the segments written completely; a short write may
+            # leave the next one partially written.
+            while start < len(segments) and written >= len(segments[start]):
+                written -= len(segments[start])
+                start += 1
+            if written:
+                segments[start] = segments[start][written:]
+        getattr(os, 'fdatasync', os.fsync)(fd)
+    except BaseException:
+        os.close(fd)
+        os.unlink(tempname)
+        raise
+    os.close(fd)
+    os.rename(tempname, filename)
+
+def random_string(length=32):
+    """Return a random string of ``length`` hexadecimal digits."""
+    return os.urandom((length + 1) // 2).hex()[:length]
+
+# Flags from <sys/inotify.h>.
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+_INOTIFY_EVENT = struct.Struct('iIII')  # wd, mask, cookie, len
+
+def inotify_watch(path, mask):
+    """Create a non-blocking inotify descriptor watching the directory
+    ``path`` for the events in ``mask``. Returns None when inotify is
+    not available (e.g., on platforms other than Linux).
+    """
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    if libc.inotify_add_watch(fd, os.fsencode(path), mask) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+def inotify_read(fd):
+    """Drain pending events from an inotify descriptor. Returns the
+    list of file names reported; None appears in the list if the
+    kernel's event queue overflowed and events may have been lost.
+    """
+    names = []
+    while True:
+        try:
+            buf = os.read(fd, 64 * 1024)
+        except BlockingIOError:
+            return names
+        pos = 0
+        while pos < len(buf):
+            _, mask, _, length = _INOTIFY_EVENT.unpack_from(buf, pos)
+            pos += _INOTIFY_EVENT.size
+            if mask & IN_Q_OVERFLOW:
+                names.append(None)
+            elif length:
+                name = buf[pos:pos + length].rstrip(b'\0')
+                names.append(os.fsdecode(name))
+            pos += length
 
 def call(command, stdin=None):
     """Invokes a shell command as a subprocess, optionally with some
     data sent to the standard input. Returns the standard output data,
     the standard error, and the return code.
+
+    ``command`` may also be a list of arguments, which is executed
+    directly rather than through a shell.
     """
-    res = subprocess.run(command, shell=True, input=stdin,
+    res = subprocess.run(command, shell=isinstance(command, str),
+                         input=stdin,
                          stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     return res.stdout, res.stderr, res.returncode
 
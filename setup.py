@@ -19,9 +19,10 @@ setup(name='clusterfutures',
       install_requires=[
           'cloudpickle',
       ],
-      python_requires='>=3.5',
+      python_requires='>=3.8',
       extras_require={
-          'test': ['pytest', 'testpath>=0.5']
+          'test': ['pytest', 'testpath>=0.5', 'lz4'],
+          'lz4': ['lz4'],
       },
 
       classifiers=[
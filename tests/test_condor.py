@@ -42,3 +42,22 @@ def test_map():
         assert list(result_iter) == [0, 1, 4, 9]
     finally:
         executor.shutdown(wait=False)
+
+class CleanupFailed(Exception):
+    pass
+
+def test_completion_errors_are_reported(capfd, monkeypatch):
+    executor = cfut.CondorExecutor(debug=True, keep_logs=True)
+
+    def cleanup(jobid):
+        raise CleanupFailed(jobid)
+    monkeypatch.setattr(executor, '_cleanup', cleanup)
+
+    try:
+        with MockCommand.fixed_output('condor_submit', stdout='Proc 0.0'):
+            fut = executor.submit(square, 2)
+        run_all_outstanding_work()
+        assert fut.result(timeout=3) == 4
+    finally:
+        executor.shutdown()
+    assert 'CleanupFailed' in capfd.readouterr().err
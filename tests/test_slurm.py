@@ -1,6 +1,14 @@
+from concurrent import futures
+import glob
+import os
+import threading
+import time
+
+import pytest
 from testpath import MockCommand
 
 import cfut
+from cfut.util import CommandError, local_filename
 from .utils import run_all_outstanding_work
 
 def square(n):
@@ -36,3 +44,174 @@ def test_map():
 
         run_all_outstanding_work()
         assert list(result_iter) == [0, 1, 4, 9]
+
+def test_submit_array():
+    with cfut.SlurmExecutor(True, keep_logs=True) as executor:
+        with MockCommand.fixed_output('sbatch', stdout='000000') as sbatch:
+            futs = executor.submit_array(square, range(4))
+        assert len(sbatch.get_calls()) == 1
+
+        # The function is only written once, for the whole array.
+        assert len(glob.glob(local_filename('cfut.fun.*.pickle'))) == 1
+
+        run_all_outstanding_work()
+        assert [f.result(timeout=3) for f in futs] == [0, 1, 4, 9]
+    assert not glob.glob(local_filename('cfut.fun.*.pickle'))
+
+def test_map_function_uses_array():
+    executor = cfut.SlurmExecutor(True, keep_logs=True)
+    with MockCommand.fixed_output('sbatch', stdout='000000') as sbatch:
+        # The generator only submits the jobs once it starts running,
+        # and then blocks on the results, so it runs in another thread.
+        results = []
+        mapper = threading.Thread(
+            target=lambda: results.extend(cfut.map(executor, square,
+                                                   range(4))),
+            daemon=True,
+        )
+        mapper.start()
+        try:
+            deadline = time.monotonic() + 10
+            while not sbatch.get_calls():
+                assert time.monotonic() < deadline, "sbatch was not called"
+                time.sleep(0.05)
+            run_all_outstanding_work()
+
+            mapper.join(timeout=10)
+            assert not mapper.is_alive(), "map did not finish"
+        finally:
+            if mapper.is_alive():
+                executor.shutdown(wait=False)
+    assert results == [0, 1, 4, 9]
+    assert len(sbatch.get_calls()) == 1
+
+def _infiles(executor):
+    return glob.glob(local_filename(
+        'cfut.in.{}_*.pickle'.format(executor._workerid_prefix)
+    ))
+
+def test_shutdown_keeps_pending_inputs():
+    executor = cfut.SlurmExecutor(True, keep_logs=True)
+    with MockCommand.fixed_output('sbatch', stdout='000000'):
+        executor.submit(square, 2)
+    infiles = _infiles(executor)
+    assert infiles
+
+    # The job may still run after a non-waiting shutdown.
+    executor.shutdown(wait=False)
+    assert all(os.path.exists(f) for f in infiles)
+    for f in infiles:
+        os.unlink(f)
+
+def test_shutdown_removes_finished_files():
+    executor = cfut.SlurmExecutor(True, keep_logs=True)
+    with MockCommand.fixed_output('sbatch', stdout='000000'):
+        executor.submit(square, 2)
+    infiles = _infiles(executor)
+
+    # Finish the job without the executor collecting it.
+    executor.wait_thread.stop()
+    executor.wait_thread.join()
+    run_all_outstanding_work()
+
+    executor.shutdown(wait=False)
+    assert not any(os.path.exists(f) for f in infiles)
+    assert not glob.glob(local_filename(
+        'cfut.out.{}_*.pickle'.format(executor._workerid_prefix)
+    ))
+
+def test_submit_sees_current_closure():
+    factor = [2]
+    def scale(x):
+        return x * factor[0]
+
+    with cfut.SlurmExecutor(True, keep_logs=True) as executor:
+        with MockCommand('sbatch', python=SBATCH_JOB_COUNT):
+            fut1 = executor.submit(scale, 1)
+            factor[0] = 10
+            fut2 = executor.submit(scale, 1)
+
+        run_all_outstanding_work()
+        assert fut1.result(timeout=3) == 2
+        assert fut2.result(timeout=3) == 10
+
+def test_shutdown_keeps_pending_function_file():
+    executor = cfut.SlurmExecutor(True, keep_logs=True)
+    with MockCommand.fixed_output('sbatch', stdout='000000'):
+        executor.submit_array(square, range(2))
+    funfiles = glob.glob(local_filename(
+        'cfut.fun.{}_*.pickle'.format(executor._workerid_prefix)
+    ))
+    assert len(funfiles) == 1
+
+    executor.shutdown(wait=False)
+    assert os.path.exists(funfiles[0])
+
+    # The tasks can still run afterwards.
+    run_all_outstanding_work()
+    for f in funfiles + _infiles(executor) + glob.glob(local_filename(
+            'cfut.out.{}_*.pickle'.format(executor._workerid_prefix))):
+        os.unlink(f)
+
+def test_submit_array_splits_large_arrays():
+    with cfut.SlurmExecutor(True, keep_logs=True,
+                            max_array_size=2) as executor:
+        with MockCommand('sbatch', python=SBATCH_JOB_COUNT) as sbatch:
+            futs = executor.submit_array(square, range(5))
+        assert len(sbatch.get_calls()) == 3
+
+        run_all_outstanding_work()
+        assert [f.result(timeout=3) for f in futs] == [0, 1, 4, 9, 16]
+
+def test_submit_array_failure_removes_files():
+    with cfut.SlurmExecutor(True, keep_logs=True) as executor:
+        with MockCommand.fixed_output('sbatch', exit_status=1):
+            with pytest.raises(CommandError):
+                executor.submit_array(square, range(3))
+        assert not glob.glob(local_filename(
+            'cfut.*.{}_*.pickle'.format(executor._workerid_prefix)
+        ))
+
+def test_completion_retries_unreadable_output():
+    with cfut.SlurmExecutor(True, keep_logs=True) as executor:
+        with MockCommand.fixed_output('sbatch', stdout='000000'):
+            fut = executor.submit(square, 3)
+
+        # A spurious report (e.g., the output is not readable yet) keeps
+        # the job waiting instead of failing it.
+        executor._completion(0)
+        assert 0 in executor.jobs
+        assert not fut.done()
+
+        run_all_outstanding_work()
+        assert fut.result(timeout=3) == 9
+
+def test_shutdown_leaves_queued_completions(capfd):
+    executor = cfut.SlurmExecutor(True)
+    # Keep a single-threaded completion pool busy, so that completions
+    # are still queued when shutdown returns.
+    executor.completion_pool.shutdown()
+    executor.completion_pool = futures.ThreadPoolExecutor(1)
+    release = threading.Event()
+    executor.completion_pool.submit(release.wait, 10)
+
+    try:
+        with MockCommand.fixed_output('sbatch', stdout='000000'):
+            futs = executor.submit_array(square, range(2))
+        run_all_outstanding_work()
+        deadline = time.monotonic() + 10
+        while len(executor.completing) < 2:
+            assert time.monotonic() < deadline, "jobs were not dispatched"
+            time.sleep(0.05)
+
+        executor.shutdown(wait=False)
+        assert len(_infiles(executor)) == 2
+    finally:
+        release.set()
+        executor.shutdown(wait=False)
+
+    assert [f.result(timeout=3) for f in futs] == [0, 1]
+    executor.completion_pool.shutdown()
+    assert not _infiles(executor)
+    assert not executor.arrays
+    assert 'error while completing job' not in capfd.readouterr().err
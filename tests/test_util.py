@@ -0,0 +1,102 @@
+import pickle
+import sys
+import types
+
+import cloudpickle
+import pytest
+
+from cfut.remote import load_function
+from cfut.util import (
+    COMPRESS_THRESHOLD, FUNIMPORT_TAG, dumps, dump_function, loads,
+    pack_frames, unpack_frames, read_file, write_file,
+)
+
+def test_frames_roundtrip():
+    frames = [b'abc', b'', b'defgh']
+    data = b''.join(pack_frames(frames))
+    assert [bytes(f) for f in unpack_frames(data)] == frames
+
+def test_out_of_band_buffers():
+    payload = bytearray(b'x' * 1000)
+    frames = dumps({'data': pickle.PickleBuffer(payload)})
+    # The buffer is passed through as its own frame, not copied into
+    # the pickle stream.
+    assert len(frames) == 2
+    assert len(frames[0]) < len(payload)
+
+    data = b''.join(pack_frames(frames))
+    obj = loads(unpack_frames(data))
+    assert bytes(obj['data']) == bytes(payload)
+
+def test_write_file(tmp_path):
+    filename = str(tmp_path / 'out')
+    segments = [b'a' * n for n in range(3000)]
+    write_file(filename, segments)
+    assert read_file(filename) == b''.join(segments)
+    assert not (tmp_path / 'out.tmp').exists()
+
+def _roundtrip(obj):
+    return loads(unpack_frames(b''.join(pack_frames(dumps(obj)))))
+
+def test_dumps_falls_back_to_cloudpickle():
+    offset = 3
+    args, kwargs = _roundtrip(((lambda x: x + offset,), {'n': 2}))
+    assert args[0](1) == 4
+    assert kwargs == {'n': 2}
+
+def test_dumps_main_by_value():
+    def double(x):
+        return 2 * x
+    double.__module__ = '__main__'
+    double.__qualname__ = 'double'
+    assert _roundtrip(double)(5) == 10
+
+@pytest.mark.parametrize('compress', [False, True])
+def test_large_message(compress):
+    if compress:
+        pytest.importorskip('lz4.frame')
+    frames = [b'header', bytes(COMPRESS_THRESHOLD * 2)]
+    segments = pack_frames(frames, compress=compress)
+    data = b''.join(segments)
+    if compress:
+        assert len(data) < COMPRESS_THRESHOLD
+    assert [bytes(f) for f in unpack_frames(data)] == frames
+
+def square(n):
+    return n * n
+
+def test_dump_function_by_name():
+    funser = dump_function(square)
+    assert funser.startswith(FUNIMPORT_TAG)
+    assert load_function(funser) is square
+
+def test_dump_function_closure():
+    offset = 3
+    funser = dump_function(lambda x: x + offset)
+    assert not funser.startswith(FUNIMPORT_TAG)
+    assert load_function(funser)(1) == 4
+
+@pytest.fixture
+def by_value_module():
+    if not hasattr(cloudpickle, 'register_pickle_by_value'):
+        pytest.skip("cloudpickle has no register_pickle_by_value")
+    module = types.ModuleType('cfut_test_by_value')
+    exec('def triple(x):\n    return 3 * x\n', module.__dict__)
+    sys.modules[module.__name__] = module
+    cloudpickle.register_pickle_by_value(module)
+    try:
+        yield module
+    finally:
+        cloudpickle.unregister_pickle_by_value(module)
+        sys.modules.pop(module.__name__, None)
+
+def test_registered_by_value(by_value_module):
+    funser = dump_function(by_value_module.triple)
+    frames = pack_frames(dumps(([by_value_module.triple], {})))
+    assert not funser.startswith(FUNIMPORT_TAG)
+
+    # The workers cannot import the module.
+    del sys.modules[by_value_module.__name__]
+    assert load_function(funser)(2) == 6
+    args, _ = loads(unpack_frames(b''.join(frames)))
+    assert args[0](2) == 6
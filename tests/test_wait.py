@@ -0,0 +1,72 @@
+import os
+import threading
+
+import pytest
+
+import cfut
+
+def _publish(path):
+    with open(path + '.tmp', 'w') as f:
+        f.write('done')
+    os.rename(path + '.tmp', path)
+
+def _run_wait_thread(tmp_path, interval, inotify, monkeypatch):
+    done = threading.Event()
+    seen = []
+
+    def callback(value):
+        with open(filename) as f:
+            seen.append((value, f.read()))
+        done.set()
+
+    if not inotify:
+        monkeypatch.setattr(cfut, 'inotify_watch', lambda *args: None)
+    filename = os.path.join(str(tmp_path), 'result')
+    thread = cfut.FileWaitThread(callback, interval=interval,
+                                 directory=str(tmp_path))
+    if inotify and thread.inotify_fd is None:
+        pytest.skip("inotify is not available")
+    thread.start()
+    try:
+        thread.wait(filename, 42)
+        _publish(filename)
+        assert done.wait(timeout=3)
+        assert seen == [(42, 'done')]
+    finally:
+        thread.stop()
+        thread.join()
+
+
+def test_wait_inotify(tmp_path, monkeypatch):
+    # The poll interval is long, so the file has to be seen by inotify.
+    _run_wait_thread(tmp_path, interval=30, inotify=True,
+                     monkeypatch=monkeypatch)
+
+def test_wait_polling(tmp_path, monkeypatch):
+    _run_wait_thread(tmp_path, interval=0.1, inotify=False,
+                     monkeypatch=monkeypatch)
+
+def test_stop_is_prompt(tmp_path):
+    thread = cfut.FileWaitThread(lambda value: None, interval=30,
+                                 directory=str(tmp_path))
+    thread.start()
+    thread.stop()
+    thread.join(timeout=5)
+    assert not thread.is_alive()
+
+def test_poll_survives_listing_errors(tmp_path, monkeypatch):
+    def scandir(path):
+        raise PermissionError(path)
+    monkeypatch.setattr(os, 'scandir', scandir)
+
+    seen = []
+    thread = cfut.FileWaitThread(seen.append, directory=str(tmp_path))
+    thread.waiting[os.path.join(str(tmp_path), 'result')] = 1
+    thread._poll()
+    assert seen == []
+    assert thread.waiting
+
+    # Let the thread close its descriptors.
+    thread.start()
+    thread.stop()
+    thread.join()